@@ -6,14 +6,44 @@ Entry point functions, and factorized building blocks implementing all functiona
 
 import os
 import sys
-import copy
-import math
-import yaml
-import uuid
-import fcntl
-import shutil
-import socket
-import subprocess
+import functools
+import collections
+# further modules are imported lazily by the functions that need them, keeping the startup of `cnd` lean
+
+# parsed YAML files, keyed by (absolute path, mtime, size) of the file, least recently used entries are evicted first
+_CFG_CACHE = collections.OrderedDict()
+_CFG_CACHE_MAXLEN = 16
+
+# mount status per mount point as determined or caused during the present command invocation
+_MOUNT_STATE = {}
+
+# constant text blocks of the generated files, encoded once at import
+_ENVIRONMENT_YML_HEADER = (
+    b"# Conda environment definition file\n"
+    b"# This file is only provided as an example, replace it with your own file!\n"
+    b"# Hints on editing manually are available online:\n"
+    b"# https://conda.io/projects/conda/en/latest/user-guide/tasks/manage-environments.html#creating-an-environment-file-manually\n"
+)
+_CFG_HEADER = (
+    b"# Condainer project configuration file\n"
+    b"#\n"
+    b"# - initially created by `condainer init`\n"
+    b"# - can be edited by hand, if necessary\n"
+    b"# - more information at https://gitlab.mpcdf.mpg.de/mpcdf/condainer\n"
+    b"#\n"
+)
+_ACTIVATE_HEADER = (
+    b"# usage: source activate\n"
+    b"# - must be sourced from the condainer project directory\n"
+    b"# - only bourne shells are supported, such as bash or zsh\n"
+    b"cnd --quiet mount\n"
+)
+_DEACTIVATE_SCRIPT = (
+    b"# usage: source deactivate\n"
+    b"# - only bourne shells are supported, such as bash or zsh\n"
+    b"conda deactivate\n"
+    b"[[ $- == *i* ]] && echo \"Hint: In case the environment is not activated in any other shell, please run now: cnd umount\"\n"
+)
 
 
 class termcol:
@@ -43,93 +73,322 @@ dependencies:
     return raw
 
 
+@functools.lru_cache(maxsize=None)
+def _get_yaml():
+    """Import PyYAML upon first use, return the module together with the safe loader and dumper classes,
+    using the libyaml-based C implementation if available, falling back to the pure Python one.
+    """
+    import yaml
+    try:
+        from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+    except ImportError:
+        from yaml import SafeLoader as Loader, SafeDumper as Dumper
+    return yaml, Loader, Dumper
+
+
+def yaml_load(stream):
+    """Parse YAML from stream.
+    """
+    yaml, Loader, _ = _get_yaml()
+    return yaml.load(stream, Loader=Loader)
+
+
+def yaml_dump(data, **kwargs):
+    """Serialize data to a YAML string.
+    """
+    yaml, _, Dumper = _get_yaml()
+    return yaml.dump(data, Dumper=Dumper, **kwargs)
+
+
+def write_file_atomic(filename, payload, mode=None):
+    """Write the payload (str or bytes) to filename in a single call via a temporary file
+    which then atomically replaces filename, optionally setting the permission bits to mode.
+    """
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_filename, 'wb' if isinstance(payload, bytes) else 'w') as fp:
+            fp.write(payload)
+        if mode is not None:
+            os.chmod(tmp_filename, mode)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
 def write_example_environment_yml():
     """Write minimal usable environment.yml as an example.
     """
-    with open('environment.yml', 'w') as fp:
-        fp.write("# Conda environment definition file\n")
-        fp.write("# This file is only provided as an example, replace it with your own file!\n")
-        fp.write("# Hints on editing manually are available online:\n")
-        fp.write("# https://conda.io/projects/conda/en/latest/user-guide/tasks/manage-environments.html#creating-an-environment-file-manually\n")
-        environment_yml = get_example_environment_yml()
-        fp.write(environment_yml)
+    payload = _ENVIRONMENT_YML_HEADER + get_example_environment_yml().encode()
+    write_file_atomic('environment.yml', payload)
 
 
 def write_cfg(cfg, cfg_yml='condainer.yml'):
     """Write config dictionary to YAML.
     """
-    with open(cfg_yml, 'w') as fp:
-        fp.write("# Condainer project configuration file\n")
-        fp.write("#\n")
-        fp.write("# - initially created by `condainer init`\n")
-        fp.write("# - can be edited by hand, if necessary\n")
-        fp.write("# - more information at https://gitlab.mpcdf.mpg.de/mpcdf/condainer\n")
-        fp.write("#\n")
-        fp.write(yaml.safe_dump(cfg, sort_keys=False))
+    # derived entries (leading underscore) are kept in memory only
+    persistent_cfg = {key: value for key, value in cfg.items() if not key.startswith('_')}
+    payload = _CFG_HEADER + yaml_dump(persistent_cfg, sort_keys=False).encode()
+    write_file_atomic(cfg_yml, payload)
+    # refresh the JSON cache right away, sparing the next reader the YAML parse
+    write_cfg_json(persistent_cfg, cfg_yml, os.stat(cfg_yml))
+
+
+def get_cfg_json_filename(cfg_yml):
+    """Return the name of the hidden JSON file caching the contents of the YAML file cfg_yml.
+    """
+    directory, filename = os.path.split(cfg_yml)
+    return os.path.join(directory, "." + filename + ".json")
+
+
+def write_cfg_json(cfg, cfg_yml, st):
+    """Cache the parsed contents of cfg_yml as JSON, stamped with the modification time and size of the YAML file.
+    Failing to write the cache (e.g. read-only directory, data not representable in JSON) is not an error.
+    """
+    import json
+    try:
+        payload = json.dumps({'yml_stamp': [st.st_mtime_ns, st.st_size], 'cfg': cfg}, separators=(',', ':'))
+        # JSON silently turns e.g. integer keys into strings, only cache data that survives the round trip unchanged
+        if json.loads(payload)['cfg'] != cfg:
+            return
+        write_file_atomic(get_cfg_json_filename(cfg_yml), payload)
+    except (OSError, TypeError, ValueError):
+        pass
+
+
+def read_cfg_json(cfg_yml, st):
+    """Return the cached parsed contents of cfg_yml from its JSON file, or None if it does not exist, is outdated, or is invalid.
+    """
+    import json
+    try:
+        with open(get_cfg_json_filename(cfg_yml), 'r') as fp:
+            cfg_json = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    # the cache may be deleted or garbled at any time, anything unexpected makes it fall back to the YAML file
+    if not isinstance(cfg_json, dict):
+        return None
+    if cfg_json.get('yml_stamp') != [st.st_mtime_ns, st.st_size]:
+        return None
+    cfg = cfg_json.get('cfg')
+    if not isinstance(cfg, dict):
+        return None
+    return cfg
 
 
 def get_cfg(cfg_yml='condainer.yml'):
-    """Read a config dictionary from YAML, and return.
+    """Read the condainer config dictionary from YAML, and return.
+    Repeated calls within the same process are served from a cache as long as the file is unchanged,
+    each call returns a copy such that callers may add or replace entries freely.
     """
-    with open(cfg_yml, 'r') as fp:
-        cfg = yaml.safe_load(fp)
+    st = os.stat(cfg_yml)
+    key = (os.path.abspath(cfg_yml), st.st_mtime_ns, st.st_size)
+    cfg = _CFG_CACHE.get(key)
+    if cfg is None:
+        cfg = read_cfg_json(cfg_yml, st)
+        if cfg is None:
+            with open(cfg_yml, 'r') as fp:
+                cfg = yaml_load(fp)
+            write_cfg_json(cfg, cfg_yml, st)
+        if isinstance(cfg, dict) and ('uuid' in cfg):
+            set_derived_cfg(cfg)
+        _CFG_CACHE[key] = cfg
+        while len(_CFG_CACHE) > _CFG_CACHE_MAXLEN:
+            _CFG_CACHE.popitem(last=False)
+    else:
+        _CFG_CACHE.move_to_end(key)
+    # the config is a flat mapping of scalars, so a shallow copy suffices to keep the cached entry intact
+    if isinstance(cfg, dict):
+        return dict(cfg)
     return cfg
 
 
+def set_derived_cfg(cfg):
+    """Precompute the file and directory names derived from a condainer config, and store them under keys with a leading underscore.
+    """
+    cfg['_base_env_directory'] = get_base_env_directory(cfg)
+    cfg['_image_filename'] = get_image_filename(cfg)
+    cfg['_lockfilename'] = get_lockfilename(cfg)
+    if 'installer_url' in cfg:
+        cfg['_installer_path'] = get_installer_path(cfg)
+    if 'conda_exe' in cfg:
+        cfg['_conda_exe'] = get_conda_exe(cfg)
+    cfg['_activate'] = get_activate_script(cfg)
+
+
 def get_base_env_directory(cfg):
     """Determine and return the base directory of the environment (which is identical to the squashfuse mount point).
     """
-    if cfg.get('multiuser_mountpoint'):
+    if '_base_env_directory' in cfg:
+        return cfg['_base_env_directory']
+    return _get_base_env_directory(cfg['mount_base_directory'], cfg['uuid'], bool(cfg.get('multiuser_mountpoint')))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_base_env_directory(mount_base_directory, uuid, multiuser_mountpoint):
+    """Memoized implementation of get_base_env_directory(), keyed by the relevant config entries.
+    """
+    if multiuser_mountpoint:
         suffix = '-' + str(os.getuid())
         # we cannot add the slurm job id because this would break compiled extensions linking back to libraries provided by condainer
         # if os.environ.get('SLURM_JOB_ID'):
         #     suffix = suffix + '-' + os.environ.get('SLURM_JOB_ID')
     else:
         suffix = ''
-    return os.path.join(cfg['mount_base_directory'], "condainer-"+cfg['uuid']+suffix)
+    return os.path.join(mount_base_directory, "condainer-"+uuid+suffix)
 
 
 def get_user_env_directory(cfg):
     """Determine and return the directory of the nested conda environment.
     """
-    return os.path.join(get_base_env_directory(cfg), "envs", cfg["user_env_name"])
+    return _get_user_env_directory(get_base_env_directory(cfg), cfg["user_env_name"])
+
+
+@functools.lru_cache(maxsize=8)
+def _get_user_env_directory(base_env_directory, user_env_name):
+    """Memoized implementation of get_user_env_directory().
+    """
+    return os.path.join(base_env_directory, "envs", user_env_name)
+
+
+def get_conda_exe(cfg):
+    """Return the full path of the conda (or mamba) executable of the base environment.
+    """
+    if '_conda_exe' in cfg:
+        return cfg['_conda_exe']
+    return os.path.join(get_base_env_directory(cfg), 'bin', cfg['conda_exe'])
+
+
+def get_activate_script(cfg):
+    """Return the full path of the conda activate script of the base environment.
+    """
+    if '_activate' in cfg:
+        return cfg['_activate']
+    return os.path.join(get_base_env_directory(cfg), 'bin', 'activate')
 
 
 def get_installer_path(cfg):
     """Return the path to the Miniforge installer, either the full path including the filename,
     or the filename alone, assuming that it has been downloaded to the Condainer project directory already.
     """
+    if '_installer_path' in cfg:
+        return cfg['_installer_path']
     if cfg['installer_url'].startswith('http'):
         return os.path.basename(cfg['installer_url'])
     else:
         return cfg['installer_url']
 
 
+def download_file(url, filename, chunk_size=1<<20):
+    """Download url to filename in a single streaming pass, return the SHA-256 hex digest of the payload.
+    The data is written to a temporary file first, such that an interrupted download does not leave a truncated file behind.
+    """
+    import hashlib
+    import urllib.request
+    sha256 = hashlib.sha256()
+    tmp_filename = filename + ".part"
+    try:
+        with urllib.request.urlopen(url) as response, open(tmp_filename, 'wb') as fp:
+            while True:
+                buf = response.read(chunk_size)
+                if not buf:
+                    break
+                sha256.update(buf)
+                fp.write(buf)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+    return sha256.hexdigest()
+
+
+def _read_proc_mounts():
+    """Return the raw contents of /proc/mounts as bytes, bypassing the text I/O layer.
+    """
+    chunks = []
+    fd = os.open('/proc/mounts', os.O_RDONLY)
+    try:
+        while True:
+            buf = os.read(fd, 1<<20)
+            if not buf:
+                break
+            chunks.append(buf)
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
+def _get_proc_mounts_field(mount_point):
+    """Return the mount point as it appears in the second field of /proc/mounts, where
+    whitespace and backslashes are escaped as octal sequences.
+    """
+    escaped = mount_point.replace('\\', '\\134').replace(' ', '\\040').replace('\t', '\\011').replace('\n', '\\012')
+    return escaped.encode()
+
+
+def _in_proc_mounts(mount_point):
+    """Return True if the mount point is listed in /proc/mounts, comparing only the mount point field of each line.
+    """
+    target = _get_proc_mounts_field(mount_point)
+    data = _read_proc_mounts()
+    # cheap check first, usually the mount point does not appear anywhere in the table
+    if target not in data:
+        return False
+    for line in data.split(b'\n'):
+        sp = line.find(b' ')
+        if sp < 0:
+            continue
+        end = line.find(b' ', sp + 1)
+        if line[sp + 1:end] == target:
+            return True
+    return False
+
+
 def is_mounted(cfg):
     """Return True if the container is mounted at its respective mountpoint, False otherwise.
     """
     env_directory = get_base_env_directory(cfg)
-    q = False
-    with open('/proc/mounts', 'r') as fp:
-        for raw in fp:
-            line = raw.split()
-            if (line[1] == env_directory):
-                q = True
-                break
+    q = _MOUNT_STATE.get(env_directory)
+    if q is None:
+        # a mount point resides on a different device than its parent directory, which is what squashfuse yields
+        q = os.path.ismount(env_directory)
+        if not q:
+            try:
+                os.lstat(env_directory)
+            except FileNotFoundError:
+                # no mount point, nothing can be mounted there
+                pass
+            except OSError:
+                # the mount point cannot be stat'ed (e.g. stale FUSE daemon), consult the mount table instead
+                q = _in_proc_mounts(env_directory)
+        _MOUNT_STATE[env_directory] = q
     return q
 
 
+def invalidate_mount_cache():
+    """Forget the mount status remembered by is_mounted(), forcing a fresh check upon the next call.
+    """
+    _MOUNT_STATE.clear()
+
+
 def get_image_filename(cfg):
     """Return image filename which is 'UUID.squashfs' by convention.
     """
+    if '_image_filename' in cfg:
+        return cfg['_image_filename']
     return cfg['uuid']+".squashfs"
 
 
 def get_activate_cmd(cfg):
     """Return the shell command necessary to `activate` the condainer environment.
     """
-    env_directory = get_base_env_directory(cfg)
-    activate = os.path.join(os.path.join(env_directory, 'bin'), 'activate')
+    activate = get_activate_script(cfg)
     user_env_name = cfg["user_env_name"]
     return f"source {activate} {user_env_name}"
 
@@ -137,52 +396,108 @@ def get_activate_cmd(cfg):
 def write_activate_script(cfg):
     """Create the `activate` script (mounting the condainer and activating the condainer env).
     """
-    with open("activate", 'w') as fp:
-        fp.write("# usage: source activate\n")
-        fp.write("# - must be sourced from the condainer project directory\n")
-        fp.write("# - only bourne shells are supported, such as bash or zsh\n")
-        fp.write("cnd --quiet mount\n")
-        cmd = get_activate_cmd(cfg)
-        fp.write(f"{cmd}\n")
-    os.chmod("activate", 0o755)
+    payload = _ACTIVATE_HEADER + f"{get_activate_cmd(cfg)}\n".encode()
+    write_file_atomic("activate", payload, mode=0o755)
 
 
 def write_deactivate_script(cfg):
     """Create the `deactivate` script (deactivating the condainer env and hinting at unmounting the condainer).
     """
-    with open("deactivate", 'w') as fp:
-        fp.write("# usage: source deactivate\n")
-        fp.write("# - only bourne shells are supported, such as bash or zsh\n")
-        cmd = "conda deactivate"
-        fp.write(f"{cmd}\n")
-        fp.write("[[ $- == *i* ]] && echo \"Hint: In case the environment is not activated in any other shell, please run now: cnd umount\"\n")
-    os.chmod("deactivate", 0o755)
+    write_file_atomic("deactivate", _DEACTIVATE_SCRIPT, mode=0o755)
 
 
 def get_lockfilename(cfg):
     """Return lock file name unique to the present project and host name.
     """
-    return get_base_env_directory(cfg)+"-"+socket.gethostname()+".mutex"
+    if '_lockfilename' in cfg:
+        return cfg['_lockfilename']
+    return get_base_env_directory(cfg)+"-"+_get_hostname()+".mutex"
+
+
+def get_keepfilename(cfg):
+    """Return the name of the marker file indicating that `exec` keeps the image mounted, unique to the present project and host name.
+    Its modification time records when the mount was used last.
+    """
+    return get_base_env_directory(cfg)+"-"+_get_hostname()+".kept"
+
+
+def touch_keepfile(cfg):
+    """Create or refresh the marker file of a mount kept by `exec`.
+    """
+    keepfile = get_keepfilename(cfg)
+    with open(keepfile, 'a'):
+        os.utime(keepfile)
+
+
+def remove_keepfile(cfg):
+    """Remove the marker file of a mount kept by `exec`, if any.
+    """
+    try:
+        os.unlink(get_keepfilename(cfg))
+    except FileNotFoundError:
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def _get_hostname():
+    """Return the host name, determined only once per process.
+    """
+    import socket
+    return socket.gethostname()
 
 
 def acquire_lock(lock_file):
     """Try to acquire a file-based mutex and return its file handle, or None.
     """
+    import fcntl
+    # the lock file is persistent and neither truncated nor unlinked, only its lock state matters
+    lock_fh = open(lock_file, 'a+')
     try:
-        lock_fh = open(lock_file, 'w')
         fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
         return lock_fh
     except BlockingIOError:
+        lock_fh.close()
         return None
 
 
 def release_lock(lock_fh):
-    """Release mutex, unlink lock file.
+    """Release mutex, the lock is dropped when the file is closed.
     """
     if lock_fh:
-        fcntl.flock(lock_fh, fcntl.LOCK_UN)
-        os.unlink(lock_fh.name)
-        lock_fh.close()
+        try:
+            lock_fh.close()
+        except OSError:
+            pass
+
+
+def get_build_environ():
+    """Return a copy of the process environment for the conda installer and tools, without PYTHONPATH.
+    """
+    return {key: value for key, value in os.environ.items() if key != "PYTHONPATH"}
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    """Return the full path of the executable name, or None if not found, searching PATH only once per process.
+    """
+    import shutil
+    return shutil.which(name)
+
+
+def _tool(name):
+    """Return the full path of an external tool such that launching it does not search PATH again, or name itself if not found.
+    """
+    return _which(name) or name
+
+
+def _run(cmd, env=None, cwd=None, check=True):
+    """Run command (argument list) in a sub-process and return its exit status,
+    raise CalledProcessError in case it fails unless `check=False` is given.
+    """
+    import subprocess
+    # file descriptors inherited by `cnd` are closed in the child (default), such that e.g. the long-lived
+    # squashfuse daemon does not keep locks or pipe ends of the calling shell open
+    return subprocess.run(cmd, env=env, cwd=cwd, check=check).returncode
 
 
 def create_base_environment(cfg, args):
@@ -190,44 +505,39 @@ def create_base_environment(cfg, args):
     """
     conda_installer = get_installer_path(cfg)
     env_directory = get_base_env_directory(cfg)
-    cmd = f"/bin/bash {conda_installer} -b -f -p {env_directory}".split()
-    env = copy.deepcopy(os.environ)
-    if "PYTHONPATH" in env:
-        del env["PYTHONPATH"]
+    cmd = ["/bin/bash", conda_installer, "-b", "-f", "-p", env_directory]
+    env = get_build_environ()
+    # non-interactive bash reads no rc files, except for BASH_ENV which e.g. environment modules set on HPC systems
+    env.pop("BASH_ENV", None)
     if args.dryrun:
         print(f"dryrun: {' '.join(cmd)}")
     else:
-        proc = subprocess.Popen(cmd, shell=False, env=env)
-        proc.communicate()
-        assert(proc.returncode == 0)
+        _run(cmd, env=env)
         condarc = {}
         condarc["channels"] = ["conda-forge", "nodefaults",]
         condarc["envs_dirs"] = [os.path.join(env_directory, 'envs'),]
         condarc_yml = os.path.join(env_directory, '.condarc')
         with open(condarc_yml, 'w') as fp:
-            fp.write(yaml.safe_dump(condarc))
+            fp.write(yaml_dump(condarc))
 
 
 def create_condainer_environment(cfg, args):
     """Install user-defined software stack (environment.yml) into 'condainer' environment.
     """
-    env_directory = get_base_env_directory(cfg)
-    exe = os.path.join(os.path.join(env_directory, 'bin'), cfg['conda_exe'])
+    exe = get_conda_exe(cfg)
     environment_yml = cfg["environment_yml"]
-    environment_cfg = get_cfg(environment_yml)
+    # parsed directly, the file may reside outside the project directory and is read only once
+    with open(environment_yml, 'r') as fp:
+        environment_cfg = yaml_load(fp)
     user_env_name = environment_cfg.get("name", "env") + "@condainer"
-    cmd = f"{exe} env create --file {environment_yml} --name {user_env_name}".split()
+    cmd = [exe, "env", "create", "--file", environment_yml, "--name", user_env_name]
     cfg["user_env_name"] = user_env_name
-    env = copy.deepcopy(os.environ)
-    if "PYTHONPATH" in env:
-        del env["PYTHONPATH"]
+    env = get_build_environ()
     if args.dryrun:
         print(f"dryrun: {' '.join(cmd)}")
         write_cfg(cfg)
     else:
-        proc = subprocess.Popen(cmd, shell=False, env=env)
-        proc.communicate()
-        assert(proc.returncode == 0)
+        _run(cmd, env=env)
         cfg["user_env_name"] = user_env_name
         write_cfg(cfg)
 
@@ -238,16 +548,12 @@ def pip_condainer_environment(cfg, args):
     exe = os.path.join(get_user_env_directory(cfg), 'bin', 'pip3')
     requirements_txt = cfg["requirements_txt"]
     if os.path.isfile(requirements_txt):
-        cmd = f"{exe} install --requirement {requirements_txt} --no-cache-dir".split()
-        env = copy.deepcopy(os.environ)
-        if "PYTHONPATH" in env:
-            del env["PYTHONPATH"]
+        cmd = [exe, "install", "--requirement", requirements_txt, "--no-cache-dir"]
+        env = get_build_environ()
         if args.dryrun:
             print(f"dryrun: {' '.join(cmd)}")
         else:
-            proc = subprocess.Popen(cmd, shell=False, env=env)
-            proc.communicate()
-            assert(proc.returncode == 0)
+            _run(cmd, env=env)
     else:
         if not args.quiet:
             print(f"{requirements_txt} not found, skipping pip")
@@ -256,18 +562,13 @@ def pip_condainer_environment(cfg, args):
 def clean_environment(cfg, args):
     """Delete pkg files and other unnecessary files from base environment.
     """
-    env_directory = get_base_env_directory(cfg)
-    exe = os.path.join(os.path.join(env_directory, 'bin'), cfg['conda_exe'])
-    cmd = f"{exe} clean --all --yes".split()
-    env = copy.deepcopy(os.environ)
-    if "PYTHONPATH" in env:
-        del env["PYTHONPATH"]
+    exe = get_conda_exe(cfg)
+    cmd = [exe, "clean", "--all", "--yes"]
+    env = get_build_environ()
     if args.dryrun:
         print(f"dryrun: {' '.join(cmd)}")
     else:
-        proc = subprocess.Popen(cmd, shell=False, env=env)
-        proc.communicate()
-        assert(proc.returncode == 0)
+        _run(cmd, env=env)
 
 
 def get_user_slice_cpu_equivalents():
@@ -295,66 +596,90 @@ def get_user_slice_cpu_equivalents():
 def get_squashfs_num_threads():
     """Determine and return the number of threads to be used for `mksquashfs`
     """
+    import math
     # on large shared login nodes, we need to limit the number of threads
     n_threads_limit = 8
-    # get the number of vcores that is actually available to the process
+    # get the number of vcores that is actually available to the process,
+    # limited by the cpu affinity mask (e.g. inside a Slurm job) and by a user slice cpu quota, if any
+    n_affinity = len(os.sched_getaffinity(0))
     n_cpus = get_user_slice_cpu_equivalents()
     if n_cpus < 0:
-        n_threads = n_threads_limit
+        n_threads = min(n_threads_limit, n_affinity)
     else:
-        n_threads = math.ceil(n_cpus)
-    return n_threads
+        n_threads = min(math.ceil(n_cpus), n_affinity)
+    return max(n_threads, 1)
 
 
-def compress_environment(cfg, args, read_only_flags=True):
+def compress_environment(cfg, args, read_only_flags=False):
     """Create squashfs image from base environment.
     """
     env_directory = get_base_env_directory(cfg)
-    # explicitly set read-only flags before compressing
+    # optionally set read-only flags explicitly before compressing, the mounted image is read-only in any case
     if read_only_flags:
-        cmd = f"chmod -R a-w {env_directory}".split()
+        cmd = [_tool("chmod"), "-R", "a-w", env_directory]
         if args.dryrun:
             print(f"dryrun: {' '.join(cmd)}")
         else:
-            proc = subprocess.Popen(cmd, shell=False)
-            proc.communicate()
-            # assert(proc.returncode == 0)
+            _run(cmd, check=False)
     # compress files into image
     squashfs_image = get_image_filename(cfg)
     num_threads = get_squashfs_num_threads()
-    cmd = f"mksquashfs {env_directory}/ {squashfs_image} -noappend -processors {num_threads}".split()
+    # zstd and large blocks give smaller images and cheaper decompression for the many small files of conda environments,
+    # `cnd init` configures them for new projects, while projects lacking the keys keep the defaults of mksquashfs
+    # for quick turnaround builds, `--fast` selects lz4 which compresses at close to memory bandwidth
+    if args.fast:
+        squashfs_comp = 'lz4'
+    else:
+        squashfs_comp = cfg.get('squashfs_comp')
+    squashfs_block = cfg.get('squashfs_block')
+    cmd = [_tool("mksquashfs"), f"{env_directory}/", squashfs_image, "-noappend", "-processors", str(num_threads)]
+    if squashfs_comp:
+        cmd += ["-comp", squashfs_comp]
+    if squashfs_block:
+        cmd += ["-b", str(squashfs_block)]
+    # the compression level trades build time against image size, only some compressors support it
+    squashfs_level = cfg.get('squashfs_level')
+    if (squashfs_level is not None) and (squashfs_comp in ('gzip', 'lzo', 'zstd')):
+        cmd += ["-Xcompression-level", str(squashfs_level)]
+    if args.quiet:
+        cmd += ["-no-progress"]
+    # the package cache of conda is not needed within the read-only image, skip it instead of cleaning it beforehand,
+    # note that all arguments following `-e` are taken as exclude paths, so it must go last
+    if not cfg.get('non_conda_application'):
+        cmd += ["-e", os.path.join(env_directory, "pkgs")]
     if args.dryrun:
         print(f"dryrun: {' '.join(cmd)}")
     else:
-        proc = subprocess.Popen(cmd, shell=False)
-        proc.communicate()
-        assert(proc.returncode == 0)
+        _run(cmd)
     # restore permissions, allowing to delete the staging directory later
     if read_only_flags:
-        cmd = f"chmod -R u+w {env_directory}".split()
+        cmd = [_tool("chmod"), "-R", "u+w", env_directory]
         if args.dryrun:
             print(f"dryrun: {' '.join(cmd)}")
         else:
-            proc = subprocess.Popen(cmd, shell=False)
-            proc.communicate()
-            # assert(proc.returncode == 0)
+            _run(cmd, check=False)
 
 
-def run_cmd(args, cwd):
+def run_cmd(args, cwd, cfg=None, replace_process=False):
     """Run command in a sub-process, where PATH is prepended with the 'bin' directory of the 'condainer' environment in the container.
+    Return the exit status of the command, or 0 for a dry run.
+    With `replace_process`, the command replaces the present Python process instead, and the function does not return.
     """
-    cfg = get_cfg()
+    if cfg is None:
+        cfg = get_cfg()
     if cfg.get('non_conda_application'):
         bin_directory = os.path.join(get_base_env_directory(cfg), 'bin')
     else:
         bin_directory = os.path.join(get_user_env_directory(cfg), 'bin')
-    env = copy.deepcopy(os.environ)
-    env['PATH'] = bin_directory + ':' + env['PATH']
+    env = {**os.environ, 'PATH': bin_directory + os.pathsep + os.environ.get('PATH', '')}
     if args.dryrun:
         print(f"dryrun: {bin_directory}:{args.command}")
+        return 0
+    elif replace_process:
+        os.chdir(cwd)
+        os.execvpe(args.command[0], args.command, env)
     else:
-        proc = subprocess.Popen(args.command, cwd=cwd, env=env, shell=False)
-        proc.communicate()
+        return _run(args.command, env=env, cwd=cwd, check=False)
 
 
 # --- condainer entry point functions below ---
@@ -363,6 +688,7 @@ def run_cmd(args, cwd):
 def init(args):
     """Initialize directory with a usable configuration skeleton.
     """
+    import uuid
     # prioritize a locally provided installer, if available, expecting a full path
     www_installer_url = 'https://github.com/conda-forge/miniforge/releases/latest/download/Miniforge3-Linux-x86_64.sh'
     installer_url = os.environ.get('CONDAINER_INSTALLER')
@@ -378,6 +704,12 @@ def init(args):
     cfg["requirements_txt"] = 'requirements.txt'
     cfg['installer_url'] = installer_url
     cfg['conda_exe'] = 'mamba'
+    # --- squashfs-related settings ---
+    cfg['squashfs_comp'] = 'zstd'
+    cfg['squashfs_block'] = '1M'
+    cfg['squashfs_level'] = 3
+    # --- mount-related settings, keep the image mounted after `exec` for the given number of seconds ---
+    cfg['mount_idle_timeout'] = 0
     # Advanced: non-conda application, e.g. Matlab, default False ---
     # cfg['non_conda_application'] = args.non_conda_application
     # The following flag can be added later to the config file, e.g. when building and compressing via the OBS
@@ -398,13 +730,16 @@ def init(args):
             if not os.path.isfile(conda_installer):
                 if not args.quiet:
                     print("Downloading conda installer ...")
-                cmd = f"curl -JLO {cfg['installer_url']}".split()
                 if args.dryrun:
-                    print(f"dryrun: {' '.join(cmd)}")
+                    print(f"dryrun: download {cfg['installer_url']}")
                 else:
-                    proc = subprocess.Popen(cmd, shell=False)
-                    proc.communicate()
-                    assert(proc.returncode == 0)
+                    # the download runs in the main thread, such that Ctrl-C aborts it right away
+                    sha256 = download_file(cfg['installer_url'], conda_installer)
+                    expected_sha256 = os.environ.get('CONDAINER_INSTALLER_SHA256')
+                    if expected_sha256 and (sha256 != expected_sha256.lower()):
+                        os.unlink(conda_installer)
+                        print(f"STOP. SHA-256 checksum mismatch for the downloaded installer {conda_installer}.")
+                        sys.exit(1)
             else:
                 if not args.quiet:
                     print(f"found existing installer {conda_installer}, skipping download")
@@ -412,7 +747,6 @@ def init(args):
             if not args.quiet:
                 print(f"using installer {cfg['installer_url']}")
             assert(os.path.isfile(cfg['installer_url']))
-
         if not args.dryrun:
             write_example_environment_yml()
     else:
@@ -421,9 +755,26 @@ def init(args):
         print(env_directory)
 
 
+def get_trash_directories(cfg):
+    """Return the list of staging directories moved aside by previous builds, pending deletion.
+    """
+    import glob
+    return sorted(glob.glob(glob.escape(get_base_env_directory(cfg)) + ".trash-*"))
+
+
+def remove_in_background(directories):
+    """Delete directories by `rm` in a detached process, such that `cnd` does not have to wait for it,
+    errors of `rm` still go to stderr.
+    """
+    import subprocess
+    subprocess.Popen([_tool("rm"), "-rf", "--"] + directories, start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+
 def build(args):
     """Create conda environment and create compressed squashfs image from it.
     """
+    import uuid
     cfg = get_cfg()
     squashfs_image = get_image_filename(cfg)
     env_directory = get_base_env_directory(cfg)
@@ -435,6 +786,14 @@ def build(args):
         sys.exit(1)
     else:
         steps = {int(i) for i in args.steps.split(',')}
+        non_conda = cfg.get('non_conda_application')
+        # staged files of previous builds whose background deletion did not complete (e.g. killed at the end of a batch job)
+        stale_directories = get_trash_directories(cfg)
+        if stale_directories:
+            if not args.quiet:
+                print(f"deleting stale staged files in the background: {' '.join(stale_directories)}")
+            if not args.dryrun:
+                remove_in_background(stale_directories)
         try:
             if not args.quiet:
                 print(termcol.BOLD+"Starting Condainer build process ..."+termcol.ENDC)
@@ -442,19 +801,19 @@ def build(args):
                 print("see https://github.com/conda-forge/miniforge for details.")
             if not args.dryrun:
                 os.makedirs(env_directory, exist_ok=True, mode=0o700)
-            if (1 in steps) and (not cfg.get('non_conda_application')):
+            if (1 in steps) and (not non_conda):
                 if not args.quiet:
                     print(termcol.BOLD+termcol.CYAN+"1) Creating \"base\" environment ..."+termcol.ENDC)
                 create_base_environment(cfg, args)
-            if (2 in steps) and (not cfg.get('non_conda_application')):
+            if (2 in steps) and (not non_conda):
                 if not args.quiet:
                     print(termcol.BOLD+termcol.CYAN+f"2) Creating \"condainer\" environment from {cfg['environment_yml']} ..."+termcol.ENDC)
                 create_condainer_environment(cfg, args)
-            if (3 in steps) and (not cfg.get('non_conda_application')):
+            if (3 in steps) and (not non_conda):
                 if not args.quiet:
                     print(termcol.BOLD+termcol.CYAN+f"3) Adding packages from {cfg['requirements_txt']} via pip ..."+termcol.ENDC)
                 pip_condainer_environment(cfg, args)
-            if (4 in steps) and (not cfg.get('non_conda_application')):
+            if (4 in steps) and (not non_conda):
                 if not args.quiet:
                     print(termcol.BOLD+termcol.CYAN+"4) Cleaning environments from unnecessary files ..."+termcol.ENDC)
                 clean_environment(cfg, args)
@@ -462,7 +821,7 @@ def build(args):
                 if not args.quiet:
                     print(termcol.BOLD+termcol.CYAN+"5) Compressing installation directory into SquashFS image ..."+termcol.ENDC)
                 compress_environment(cfg, args)
-            if (6 in steps) and (not cfg.get('non_conda_application')):
+            if (6 in steps) and (not non_conda):
                 if not args.quiet:
                     print(termcol.BOLD+termcol.CYAN+"6) Creating activate and deactivate scripts ..."+termcol.ENDC)
                 if args.dryrun:
@@ -479,31 +838,39 @@ def build(args):
                 if args.dryrun:
                     print("dryrun: skipping")
                 else:
-                    shutil.rmtree(env_directory)
+                    # free the mount point atomically, and delete the many staged files in the background
+                    trash_directory = env_directory + ".trash-" + uuid.uuid4().hex
+                    os.rename(env_directory, trash_directory)
+                    if not args.quiet:
+                        print(f"deleting staged files in the background: {trash_directory}")
+                    remove_in_background([trash_directory])
             if not args.quiet:
                 print(termcol.BOLD+"Done!"+termcol.ENDC)
 
 
-def mount(args):
+def mount(args, explicit=True):
     """Mount squashfs image, skip if already mounted.
+    An `explicit` mount, i.e. one requested via the command line, is never reaped by `cnd gc`.
     """
     cfg = get_cfg()
     if cfg.get('multiuser_mountpoint'):
         assert(cfg.get('non_conda_application') == True)
+    env_directory = get_base_env_directory(cfg)
+    # a mount requested explicitly (e.g. by the activate script) must not be reaped by `cnd gc`
+    if explicit and (not args.dryrun):
+        remove_keepfile(cfg)
     if is_mounted(cfg):
         if not args.quiet:
             print("hint: condainer already mounted")
     else:
-        env_directory = get_base_env_directory(cfg)
         os.makedirs(env_directory, exist_ok=True, mode=0o700)
         squashfs_image = get_image_filename(cfg)
-        cmd = f"squashfuse {squashfs_image} {env_directory}".split()
+        cmd = [_tool("squashfuse"), squashfs_image, env_directory]
         if args.dryrun:
             print(f"dryrun: {' '.join(cmd)}")
         else:
-            proc = subprocess.Popen(cmd, shell=False)
-            proc.communicate()
-            assert(proc.returncode == 0)
+            _run(cmd)
+            _MOUNT_STATE[env_directory] = True
         if (not args.quiet) and (not cfg.get('non_conda_application')):
             activate = get_activate_cmd(cfg)
             print(termcol.BOLD+"Environment usage in the present shell"+termcol.ENDC)
@@ -512,29 +879,36 @@ def mount(args):
             # print(termcol.BOLD+"OK"+termcol.ENDC)
     # print feature necessary for the dynamic mount directory feature within the activate script
     if args.print:
-        print(get_base_env_directory(cfg))
+        print(env_directory)
 
 
-def umount(args):
+def umount(args, explicit=True):
     """Unmount squashfs image, skip if already unmounted.
+    An `explicit` unmount, i.e. one requested via the command line, also discards the marker of a mount kept by `exec`.
     """
     cfg = get_cfg()
+    env_directory = get_base_env_directory(cfg)
     if is_mounted(cfg):
-        env_directory = get_base_env_directory(cfg)
-        cmd = f"fusermount -u {env_directory}".split()
+        cmd = [_tool("fusermount"), "-u", env_directory]
         if args.dryrun:
             print(f"dryrun: {' '.join(cmd)}")
         else:
-            proc = subprocess.Popen(cmd, shell=False)
-            proc.communicate()
-            assert(proc.returncode == 0)
-            shutil.rmtree(env_directory)
+            _run(cmd)
+            _MOUNT_STATE[env_directory] = False
+            # the mount point is empty once unmounted, unless files were placed there in the meantime
+            try:
+                os.rmdir(env_directory)
+            except OSError:
+                import shutil
+                shutil.rmtree(env_directory)
         if not args.quiet:
             # print(termcol.BOLD+"OK"+termcol.ENDC)
             pass
     else:
         if not args.quiet:
             print("hint: condainer not mounted")
+    if explicit and (not args.dryrun):
+        remove_keepfile(cfg)
 
 
 def exec(args, cwd):
@@ -546,25 +920,86 @@ def exec(args, cwd):
         try:
             args.quiet = True
             args.print = False
-            mount_required = not is_mounted(cfg)
-            if mount_required:
-                mount(args)
-            run_cmd(args, cwd)
-            if mount_required:
-                umount(args)
+            # with `--persist` or an idle timeout, the mount is kept for subsequent calls and reaped later by `cnd gc`,
+            # as recorded by the marker file, mounts made elsewhere (e.g. by `cnd mount`) are left alone
+            keep_mount = args.persist or (cfg.get('mount_idle_timeout', 0) > 0)
+            mounted = is_mounted(cfg)
+            kept = mounted and os.path.isfile(get_keepfilename(cfg))
+            if mounted and (not keep_mount):
+                # the mount is not managed by `exec`, so there is nothing left to protect or clean up, release the
+                # mutex (which must not be inherited by the command and its descendants) and replace the present process
+                release_lock(lock)
+                lock = None
+                returncode = run_cmd(args, cwd, cfg, replace_process=True)
+            else:
+                # the command runs as a child process while the mutex is held, mount() skips if already mounted
+                mount(args, explicit=False)
+                # a mount made or kept before by `exec` is marked before the command starts, such that it is
+                # reaped by `cnd gc` even if the command fails, and the marker is refreshed when it finishes
+                owned = keep_mount and (not args.dryrun) and (kept or (not mounted))
+                if owned:
+                    touch_keepfile(cfg)
+                try:
+                    returncode = run_cmd(args, cwd, cfg)
+                finally:
+                    if owned:
+                        touch_keepfile(cfg)
+                if not keep_mount:
+                    umount(args, explicit=False)
         finally:
             release_lock(lock)
+        # pass on the exit status of the command, as it happens implicitly when the process is replaced
+        if returncode != 0:
+            sys.exit(returncode if returncode > 0 else 128 - returncode)
     else:
         print("Only one instance of `condainer exec` can be run at the same time. STOP.")
         sys.exit(1)
 
 
+def gc(args):
+    """Unmount squashfs image kept mounted by `exec`, once it has been idle for `mount_idle_timeout` seconds,
+    or right away if no timeout is set (e.g. for a mount kept via `exec --persist`).
+    """
+    import time
+    import subprocess
+    cfg = get_cfg()
+    mount_idle_timeout = cfg.get('mount_idle_timeout', 0)
+    keepfile = get_keepfilename(cfg)
+    # holding the mutex guarantees that no instance of `exec` is using the mount
+    lock = acquire_lock(get_lockfilename(cfg))
+    if lock:
+        try:
+            try:
+                idle_time = time.time() - os.stat(keepfile).st_mtime
+            except FileNotFoundError:
+                idle_time = None
+            if idle_time is None:
+                if not args.quiet:
+                    print("hint: condainer not kept mounted by `condainer exec`, leaving it alone")
+            elif idle_time < mount_idle_timeout:
+                if not args.quiet:
+                    print("hint: condainer was used recently, keeping it mounted")
+            else:
+                try:
+                    umount(args, explicit=False)
+                except subprocess.CalledProcessError:
+                    print("hint: failed to unmount condainer, it might still be in use")
+                else:
+                    if not args.dryrun:
+                        remove_keepfile(cfg)
+        finally:
+            release_lock(lock)
+    else:
+        if not args.quiet:
+            print("hint: condainer in use by `condainer exec`, keeping it mounted")
+
+
 def prereq(args):
     """Check if the necessary tools are locally available.
     """
     print(termcol.BOLD+"Checking for local tool availability"+termcol.ENDC)
-    for cmd in ["curl      ", "mksquashfs", "squashfuse", "fusermount"]:
-        print(f" - {cmd} : {shutil.which(cmd.strip())}")
+    for cmd in ["mksquashfs", "squashfuse", "fusermount"]:
+        print(f" - {cmd} : {_which(cmd)}")
 
 
 def status(args):
@@ -583,13 +1018,32 @@ def cache(args):
     """
     cfg = get_cfg()
     squashfs_image = get_image_filename(cfg)
-    cmd = f"dd if={squashfs_image} of=/dev/null bs=1M".split()
     if args.dryrun:
-        print(f"dryrun: {' '.join(cmd)}")
+        print(f"dryrun: read {squashfs_image} into the page cache")
     else:
-        proc = subprocess.Popen(cmd, shell=False)
-        proc.communicate()
-        assert(proc.returncode == 0)
+        fd = os.open(squashfs_image, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            # have the kernel start reading ahead the whole file asynchronously ...
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            # ... and read it through to /dev/null in kernel space, returning once the file is cached
+            with open(os.devnull, 'wb') as devnull:
+                offset = 0
+                while offset < size:
+                    try:
+                        count = os.sendfile(devnull.fileno(), fd, offset, size - offset)
+                    except OSError:
+                        # e.g. EINVAL or ENOSYS on file systems without splice support, read it in user space instead
+                        if offset > 0:
+                            raise
+                        while os.read(fd, 1 << 20):
+                            pass
+                        break
+                    if count == 0:
+                        break
+                    offset += count
+        finally:
+            os.close(fd)
 
 
 def test(args):
@@ -9,6 +9,27 @@ import argparse
 from . import version
 from . import condainer
 
+
+def print_version(args):
+    """Print version information.
+    """
+    print(version.get_descriptive_version_string())
+
+
+# subcommands and their entry points, `exec` is handled separately as it additionally needs the working directory
+_DISPATCH = {
+    'init': condainer.init,
+    'build': condainer.build,
+    'mount': condainer.mount,
+    'umount': condainer.umount,
+    'gc': condainer.gc,
+    'prereq': condainer.prereq,
+    'test': condainer.test,
+    'status': condainer.status,
+    'cache': condainer.cache,
+    'version': print_version,
+}
+
 def get_args():
     """Handle command line arguments, return args.
     """
@@ -27,15 +48,18 @@ def get_args():
     parser_init.add_argument('-n', '--non-conda-application', action='store_true', help='use condainer to store a non-conda application (advanced use case)')
 
     parser_build = subparsers.add_parser('build', help='build containerized conda environment')
-    parser_build.add_argument('-s', '--steps', type=str, default="1,2,3,4,5,6,7", help='debug option to select individual build steps, default is all steps: 1,2,3,4,5,6,7')
+    parser_build.add_argument('-s', '--steps', type=str, default="1,2,3,5,6,7", help='debug option to select individual build steps, default: 1,2,3,5,6,7, step 4 (conda clean) is optional as the package cache is excluded from the image anyway')
+    parser_build.add_argument('-f', '--fast', action='store_true', help='compress faster using lz4, at the expense of a larger image')
 
     parser_exec = subparsers.add_parser('exec', help='execute command within containerized conda environment')
+    parser_exec.add_argument('-p', '--persist', action='store_true', help='keep the environment mounted after the command has finished, for reuse by subsequent calls')
     parser_exec.add_argument('command', type=str, nargs='+', help='command line of the containerized command')
 
     parser_mount = subparsers.add_parser('mount', help='mount containerized conda environment')
     parser_mount.add_argument('-p', '--print', action='store_true', help='print the mount directory to stdout')
 
     subparsers.add_parser('umount', help='unmount ("eject") containerized conda environment')
+    subparsers.add_parser('gc', help='unmount containerized conda environment kept mounted by exec once it is idle')
     subparsers.add_parser('prereq', help='check if the necessary tools are installed')
     subparsers.add_parser('status', help='print status information about the condainer')
     subparsers.add_parser('cache', help='put condainer image into the page cache of the OS')
@@ -54,23 +78,8 @@ def cli():
     cwd = os.getcwd()
     if args.directory:
         os.chdir(args.directory)
-    if   args.subcommand == 'init':
-        condainer.init(args)
-    elif args.subcommand == 'build':
-        condainer.build(args)
-    elif args.subcommand == 'mount':
-        condainer.mount(args)
-    elif args.subcommand == 'umount':
-        condainer.umount(args)
-    elif args.subcommand == 'prereq':
-        condainer.prereq(args)
-    elif args.subcommand == 'exec':
+    if args.subcommand == 'exec':
+        # the command is run in the working directory `cnd` was called from
         condainer.exec(args, cwd)
-    elif args.subcommand == 'test':
-        condainer.test(args)
-    elif args.subcommand == 'status':
-        condainer.status(args)
-    elif args.subcommand == 'cache':
-        condainer.cache(args)
-    elif args.subcommand == 'version':
-        print(version.get_descriptive_version_string())
+    elif args.subcommand in _DISPATCH:
+        _DISPATCH[args.subcommand](args)